@@ -30,10 +30,12 @@ def airyPSFModel(wavelength, aperture, focal_length):
 
 def gaussianPSFModel(cov):
     cov = cov.to(units.micron**2).value
-    distr = multivariate_normal(mean=[0,0], cov=cov)
+    cov = multivariate_normal(mean=[0,0], cov=cov).cov  # validates and expands scalar/diagonal covariances to 2x2
+    a, b, c = np.linalg.inv(cov)[[0,0,1],[0,1,1]]
+    norm = 1 / (2 * np.pi * np.sqrt(np.linalg.det(cov)))
+    # evaluate the bivariate normal in closed form so that (broadcast) inputs of any shape are never copied
     def gaussianPSF(x: Number, y: Number) -> float:
-        shape = x.shape
-        return distr.pdf(np.array([np.ravel(x),np.ravel(y)]).T).reshape(shape)
+        return norm * np.exp(-0.5 * (a*x**2 + 2*b*x*y + c*y**2))
     return gaussianPSF
 
 
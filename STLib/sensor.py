@@ -1,7 +1,10 @@
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from .lens import Lens
 
-from scipy.signal import convolve2d
+from scipy.ndimage import convolve
+from scipy.signal import oaconvolve, choose_conv_method
 
 from astropy import units
 
@@ -13,6 +16,14 @@ from .utils import timer, type_checker, Number
 # create a new equivalency where 1 pA = 6.28e6 e-/s
 electron_current_density = [(units.pA/units.m**2, units.electron/units.s/units.m**2, lambda x: x * 6.28e6, lambda x: x / 6.28e6)]
 
+# maximum number of PSF samples to evaluate at once (per thread) in Sensor._applyPSF
+PSF_BATCH_SIZE = 2**22
+# number of threads used to evaluate the PSF in Sensor._applyPSF
+PSF_THREADS = os.cpu_count() or 1
+
+# most electrons a single source may add to one pixel, leaving headroom in the int32 pixels for overlapping sources
+_MAX_PSF_COUNT = 2**28
+
 class Sensor:
 
     @type_checker
@@ -29,12 +40,13 @@ class Sensor:
                  bias                   : Union[int, ArrayLike], 
                  full_well_capacity     : Number, 
                  adc_limit              : int,
-                 bloom                  : set, 
-                 readout_time           : Number):
+                 bloom                  : Union[set, np.ndarray], 
+                 readout_time           : Number,
+                 seed                   : Union[None, int] = None):
         
         self.width_px  = int(width_px)
         self.height_px = int(height_px)
-        self.pixels    = np.zeros((self.height_px, self.width_px)) * units.electron
+        self.pixels    = np.zeros((self.height_px, self.width_px), dtype=np.int32)  # electrons
 
         if isinstance(px_len, tuple):
             self.px_len_x = float(px_len[0]) * units.micron
@@ -60,11 +72,12 @@ class Sensor:
         self.dark_current   = dark_current  # pA / cm**2
         
         if hot_pixels is None:
-            self.hot_pixels = np.ones_like(self.pixels.value)
+            self.hot_pixels = np.ones((self.height_px, self.width_px))
         else:
             self.hot_pixels = np.asarray(hot_pixels)
             if self.hot_pixels.shape != (self.height_px, self.width_px):
                 raise ValueError("Argument `hot_pixels` must be None or 2D array_like with shape (`height_px`, `width_px`).")
+        self._hot_mask = self.hot_pixels != 1
 
         self.read_noise     = float(read_noise) * units.electron
         self.gain           = float(gain) * units.adu / units.electron
@@ -77,7 +90,7 @@ class Sensor:
             if len(bias) == 1:
                 pass
             if len(bias) == self.width_px:
-                bias = np.tile(bias, (self.height_px, 1))
+                bias = bias.reshape(1, -1)  # broadcasts over the rows in readout
             else:
                 raise _ERR_bias
         elif bias.ndim == 2:
@@ -92,12 +105,48 @@ class Sensor:
         self.bloom          = bloom
         self.readout_time   = float(readout_time) * units.s
 
-        if not self.bloom.issubset({'+x','-x','+y','-y'}):
-            raise ValueError("Argument `bloom` must be a subset of {'+x','-x','+y','-y'}.")
+        _ERR_bloom = ValueError("Argument `bloom` must be a subset of {'+x','-x','+y','-y'}, or a 2D array with odd side lengths, "
+                                "a center of 0, and non-negative entries that sum to at most 1.")
+        if isinstance(self.bloom, np.ndarray):
+            self.bloom = self.bloom.astype(float)
+            if self.bloom.ndim != 2 or self.bloom.shape[0] % 2 == 0 or self.bloom.shape[1] % 2 == 0:
+                raise _ERR_bloom
+            if self.bloom[self.bloom.shape[0]//2, self.bloom.shape[1]//2] != 0 or np.any(self.bloom < 0) or \
+               (self.bloom.sum() > 1 and not np.isclose(self.bloom.sum(), 1)):
+                raise _ERR_bloom
+        elif not self.bloom.issubset({'+x','-x','+y','-y'}):
+            raise _ERR_bloom
+
+        # large bloom kernels can be cheaper to apply with FFT-based overlap-add than with direct convolution
+        self._bloom_oa = isinstance(self.bloom, np.ndarray) and max(self.bloom.shape) > 7 and \
+                         choose_conv_method(np.empty((self.height_px, self.width_px)), self.bloom, mode='same') == 'fft'
+
+        self._rng = np.random.Generator(np.random.SFC64(seed))
+
+        # unitless copies of the above for the per-frame computations
+        self._gain_f        = float(self.gain.to_value(units.adu / units.electron))
+        self._bias_f        = np.ascontiguousarray(self.bias.to_value(units.adu))
+        self._full_well_i   = int(np.floor(self.full_well.to_value(units.electron)))  # whole electrons, like the pixels
+        self._adc_limit_f   = float(self.adc_limit.to_value(units.adu))
+        self._read_noise_f  = float(self.read_noise.to_value(units.electron))
+        self._px_area_um2   = float(self.px_area.to_value(units.micron**2))
+        self._px_len_x_um   = float(self.px_len_x.to_value(units.micron))
+        self._px_len_y_um   = float(self.px_len_y.to_value(units.micron))
+        self._px_pitch_x_um = float(self.px_pitch_x.to_value(units.micron))
+        self._px_pitch_y_um = float(self.px_pitch_y.to_value(units.micron))
+        # converts source coordinates in microns to the index of the pixel containing it
+        self._xi_scale      = self.width_px  / float((self.width  - 2*self.px_pitch_x + self.px_len_x).to_value(units.micron))
+        self._yi_scale      = self.height_px / float((self.height - 2*self.px_pitch_y + self.px_len_y).to_value(units.micron))
+        self._dark_f        = (1 * units.pA / units.cm**2).to_value(units.electron/units.s/units.micron**2, 
+                                                                    equivalencies=electron_current_density) * self._px_area_um2
+
+        # PSF integration kernel, built by bindLens for the lens PSF and integration parameters in _psf_kernel_key
+        self._psf_kernel = None
+        self._psf_kernel_key = None
         
     
     def clear(self):
-        self.pixels = np.zeros((self.height_px, self.width_px)) * units.electron
+        self.pixels.fill(0)
 
 
     def accumulate(self, 
@@ -109,25 +158,28 @@ class Sensor:
                    photon_flux_density  : ArrayLike,
                    background_flux      : ArrayLike):
         
-        exposure_time *= units.s
+        exposure_time = float(exposure_time)
+        lens_area_um2 = lens.area.to_value(units.micron**2)
         
         # source flux
 
         if len(photon_flux_density) > 0:
-            electron_dose = photon_flux_density * exposure_time * self.quantum_eff * lens.area
-            self._applyPSF(lens, xcoords, ycoords, electron_dose)
+            electron_dose_f = photon_flux_density.to_value(units.electron/units.s/units.micron**2) * exposure_time * self.quantum_eff * lens_area_um2
+            self.bindLens(lens)
+            self._applyPSF(xcoords.to_value(units.micron), ycoords.to_value(units.micron), electron_dose_f)
 
         # sky background flux
 
-        bg_electron_dose = background_flux * exposure_time * units.pixel * lens.area
-        self.pixels += np.random.poisson(bg_electron_dose.to(units.electron).value, (self.height_px, self.width_px)) * units.electron
+        bg_electron_dose_f = background_flux.to_value(units.electron/units.s/units.micron**2/units.pixel) * exposure_time * lens_area_um2
+        self.pixels += self._rng.poisson(bg_electron_dose_f, (self.height_px, self.width_px))
 
-        # dark current
+        # dark current, redrawn with the scaled rate only where there are hot pixels
 
-        dark_current = self.dark_current(temperature) * units.pA / units.cm**2
-        dark_count = dark_current.to(units.electron/units.s/units.micron**2, equivalencies=electron_current_density) * exposure_time * self.px_area
-        dark_lambda = self.hot_pixels * dark_count.to(units.electron).value
-        self.pixels += np.random.poisson(dark_lambda) * units.electron
+        dark_count_f = self.dark_current(temperature) * exposure_time * self._dark_f
+        dark = self._rng.poisson(dark_count_f, (self.height_px, self.width_px))
+        if self._hot_mask.any():
+            dark[self._hot_mask] = self._rng.poisson(self.hot_pixels[self._hot_mask] * dark_count_f)
+        self.pixels += dark
         
         # saturation and bloom
 
@@ -139,84 +191,182 @@ class Sensor:
         # global shutter
             
         # read noise
-        self.pixels += np.random.poisson(self.read_noise.to(units.electron).value, (self.height_px, self.width_px)) * units.electron
+        self.pixels += self._rng.poisson(self._read_noise_f, (self.height_px, self.width_px))
 
-        # analog to digital conversion, clip to ADC limit
-        return np.minimum(np.floor(self.pixels * self.gain) + self.bias, self.adc_limit)
+        # analog to digital conversion, clip to ADC limit (in place on a single output array)
+        adu = np.multiply(self.pixels, self._gain_f)
+        np.floor(adu, out=adu)
+        np.add(adu, self._bias_f, out=adu)
+        np.minimum(adu, self._adc_limit_f, out=adu)
+        return adu << units.adu
 
         # TODO: implement rolling shutter?
 
 
     @timer
     def _applyPSF(self, 
-                  lens          : Lens, 
-                  xcoords       : ArrayLike, 
-                  ycoords       : ArrayLike, 
-                  electron_dose : ArrayLike):
-        
-        # for each pixel, at least sample four corners for integration
-        nx = max(2, int(np.ceil((self.px_len_x / lens.psf_resolution).to(units.dimensionless_unscaled))))
-        ny = max(2, int(np.ceil((self.px_len_y / lens.psf_resolution).to(units.dimensionless_unscaled))))
-        dx = (self.px_len_x / (nx-1)).to_value(units.micron)
-        dy = (self.px_len_y / (ny-1)).to_value(units.micron)
+                  x_um          : ArrayLike,    # microns
+                  y_um          : ArrayLike, 
+                  electron_dose : ArrayLike):   # electrons
         
-        # how many pixels in the ±x/y directions to do integration, 
-        # relative to the pixel containing of center of the light source
-        px_bounds_x = int(np.ceil((lens.psf_bounds_x / self.px_len_x).to(units.dimensionless_unscaled).value))
-        px_bounds_y = int(np.ceil((lens.psf_bounds_y / self.px_len_y).to(units.dimensionless_unscaled).value))
+        # uses the PSF integration kernel from the last call to bindLens
 
-        for x, y, i in zip(xcoords, ycoords, electron_dose):
+        # find the center pixel of each source
 
-            # find the center pixel
+        x_um = np.asarray(x_um, dtype=float)
+        y_um = np.asarray(y_um, dtype=float)
+        xi = x_um * self._xi_scale
+        yi = y_um * self._yi_scale
+        xi = np.rint(xi, out=xi).astype(np.intp)
+        yi = np.rint(yi, out=yi).astype(np.intp)
+        electron_dose = np.asarray(electron_dose, dtype=float)
 
-            xi = int(np.round(x / (self.width  - 2*self.px_pitch_x + self.px_len_x) * self.width_px ).to(units.dimensionless_unscaled).value)
-            yi = int(np.round(y / (self.height - 2*self.px_pitch_y + self.px_len_y) * self.height_px).to(units.dimensionless_unscaled).value)
-
-            # integrate PSF over each pixel
-
-            xmin = max(xi - px_bounds_x, 0)
-            ymin = max(yi - px_bounds_y, 0)
-            xmax = min(xi + px_bounds_x + 1, self.width_px)  # + 1 because range doesn't include end
-            ymax = min(yi + px_bounds_y + 1, self.height_px)
-
-            idxs, idys = np.meshgrid(np.arange(xmin,xmax), np.arange(ymin,ymax))
-            x_lb = ((self.px_pitch_x * np.ravel(idxs) - self.px_len_x) - x).to(units.micron).value
-            x_ub = ((self.px_pitch_x * np.ravel(idxs))                 - x).to(units.micron).value
-            y_lb = ((self.px_pitch_y * np.ravel(idys) - self.px_len_y) - y).to(units.micron).value
-            y_ub = ((self.px_pitch_y * np.ravel(idys))                 - y).to(units.micron).value
-
-            _x = np.linspace(x_lb, x_ub, nx).T
-            _y = np.linspace(y_lb, y_ub, ny).T
-            m = idxs.size
-            # apply meshgrid to each row of _x and _y to form 3D tensor. Each slice represents one pixel.
-            X = np.broadcast_to(_x[:, None, :], (m, ny, nx))
-            Y = np.broadcast_to(_y[:, :, None], (m, ny, nx))
-
-            count = i * np.trapezoid(np.trapezoid(lens.psf(X,Y),dx=dy,axis=1),dx=dx,axis=1)
-            self.pixels[np.ravel(idys),np.ravel(idxs)] += np.random.poisson(count.to(units.electron).value) * units.electron
+        self._psf_kernel(self.pixels, self._rng, xi, yi, x_um, y_um, electron_dose)
                     
         return
+
+
+    def bindLens(self, lens: Lens):
+        '''
+        Build the PSF integration kernel for this sensor and `lens`. 
+        `accumulate` calls this automatically, and the kernel is only rebuilt when the lens PSF or its integration parameters change.
+        '''
+        key = (lens.psf,
+               lens.psf_resolution.to_value(units.micron), 
+               lens.psf_bounds_x.to_value(units.micron), 
+               lens.psf_bounds_y.to_value(units.micron))
+        if key == self._psf_kernel_key:
+            return
+        _, psf_resolution, psf_bounds_x, psf_bounds_y = key
+        
+        # for each pixel, at least sample four corners for integration
+        nx = max(2, int(np.ceil(self._px_len_x_um / psf_resolution)))
+        ny = max(2, int(np.ceil(self._px_len_y_um / psf_resolution)))
+        wx = _quadratureWeights(nx, self._px_len_x_um / (nx-1))
+        wy = _quadratureWeights(ny, self._px_len_y_um / (ny-1))
+        
+        # how many pixels in the ±x/y directions to do integration, 
+        # relative to the pixel containing of center of the light source
+        px_bounds_x = int(np.ceil(psf_bounds_x / self._px_len_x_um))
+        px_bounds_y = int(np.ceil(psf_bounds_y / self._px_len_y_um))
+        dxi = np.arange(-px_bounds_x, px_bounds_x + 1)
+        dyi = np.arange(-px_bounds_y, px_bounds_y + 1)
+
+        # sample coordinates of every pixel in the window, relative to the position (px_pitch * index) of the center pixel
+        x_samples = (self._px_pitch_x_um * dxi - self._px_len_x_um)[:, None] + np.linspace(0, self._px_len_x_um, nx)
+        y_samples = (self._px_pitch_y_um * dyi - self._px_len_y_um)[:, None] + np.linspace(0, self._px_len_y_um, ny)
+
+        self._psf_kernel = _makePSFKernel(lens.psf, dxi, dyi, x_samples, y_samples, wx, wy, 
+                                          self._px_pitch_x_um, self._px_pitch_y_um, self.width_px, self.height_px)
+        self._psf_kernel_key = key
         
 
     @timer
     def _applyBloom(self):
 
-        if not self.bloom:
-            self.pixels = np.minimum(self.pixels, self.full_well)
+        # most frames have no saturated pixels at all
+        if self.pixels.max() <= self._full_well_i:
+            return
+
+        if isinstance(self.bloom, set) and not self.bloom:
+            np.minimum(self.pixels, self._full_well_i, out=self.pixels)
             return
         
-        conv_filter = np.zeros((3,3))
-        frac = 1.0 / len(self.bloom)
-        conv_filter[1,0] = frac if '-x' in self.bloom else 0
-        conv_filter[1,2] = frac if '+x' in self.bloom else 0
-        conv_filter[0,1] = frac if '-y' in self.bloom else 0
-        conv_filter[2,1] = frac if '+y' in self.bloom else 0
+        # bloom directions form a sparse 3x3 cross, so spread the excess charge with shifted adds instead of a full convolution.
+        # Custom bloom kernels fall back to a direct or overlap-add convolution. All round the spilled charge down to whole electrons.
+        exc = np.empty_like(self.pixels)
+        spill = np.empty_like(self.pixels)
         while True:
-            excess = np.maximum(0, self.pixels - self.full_well)
-            if not any(excess.flatten().value > 0):
+            np.subtract(self.pixels, self._full_well_i, out=exc)
+            np.maximum(exc, 0, out=exc)
+            if not exc.any():
                 break
-            self.pixels -= excess
-            self.pixels += np.floor(convolve2d(excess.to(units.electron).value, conv_filter, mode='same', boundary='fill', fillvalue=0)) * units.electron
+            if self._bloom_oa:
+                spill_f = oaconvolve(exc, self.bloom, mode='same')
+                spill_f += 1e-3  # absorb FFT round-off before rounding down
+                np.maximum(spill_f, 0, out=spill_f)
+                np.floor(spill_f, out=spill_f)
+                spill[...] = spill_f
+            elif isinstance(self.bloom, np.ndarray):
+                convolve(exc, self.bloom, output=spill, mode='constant', cval=0.0)  # truncated to the integer output
+            else:
+                spill.fill(0)
+                if '+x' in self.bloom:
+                    spill[:, 1:] += exc[:, :-1]
+                if '-x' in self.bloom:
+                    spill[:, :-1] += exc[:, 1:]
+                if '+y' in self.bloom:
+                    spill[1:, :] += exc[:-1, :]
+                if '-y' in self.bloom:
+                    spill[:-1, :] += exc[1:, :]
+                spill //= len(self.bloom)
+            self.pixels -= exc
+            self.pixels += spill
         
         return
-    
\ No newline at end of file
+
+
+def _makePSFKernel(psf, dxi, dyi, x_samples, y_samples, wx, wy, px_pitch_x, px_pitch_y, width_px, height_px):
+    '''
+    Returns a function that integrates `psf` over the pixel window around each source and adds the 
+    Poisson sampled electrons to the sensor pixels. The sensor and lens geometry is fixed inside the closure.
+    '''
+    kx, nx = x_samples.shape
+    ky, ny = y_samples.shape
+
+    def integrate(xi, yi, x_um, y_um, electron_dose):
+        idxs = xi[:, None] + dxi
+        idys = yi[:, None] + dyi
+
+        # sample coordinates relative to each source, shape (source, column, nx) and (source, row, ny)
+        _x = (px_pitch_x * xi - x_um)[:, None, None] + x_samples
+        _y = (px_pitch_y * yi - y_um)[:, None, None] + y_samples
+        m = len(_x)
+        # 5D tensor of shape (source, row, column, ny, nx). The last two dims are the integration grid of one pixel.
+        X = np.broadcast_to(_x[:, None, :, None, :], (m, ky, kx, ny, nx))
+        Y = np.broadcast_to(_y[:, :, None, :, None], (m, ky, kx, ny, nx))
+
+        count = electron_dose[:, None, None] * np.einsum('...ji,j,i->...', psf(X,Y), wy, wx)
+
+        # drop the parts of each window that fall outside the sensor, and flatten the rest to linear pixel indices
+        on_sensor = ((idys >= 0) & (idys < height_px))[:, :, None] & ((idxs >= 0) & (idxs < width_px))[:, None, :]
+        lin = idys[:, :, None] * width_px + idxs[:, None, :]
+        return lin[on_sensor], count[on_sensor]
+
+    def psfKernel(pixels, rng, xi, yi, x_um, y_um, electron_dose):
+
+        # integrate PSF over each pixel, splitting the sources into batches of at most PSF_BATCH_SIZE samples
+        batch = max(1, min(PSF_BATCH_SIZE // (ky * kx * ny * nx), -(-len(xi) // PSF_THREADS)))
+        batches = [slice(start, start + batch) for start in range(0, len(xi), batch)]
+
+        # numpy and scipy release the GIL while evaluating the PSF, so batches are integrated in parallel threads.
+        # Random draws happen in order from this thread, which keeps them reproducible.
+        all_lin = []
+        all_counts = []
+        with ThreadPoolExecutor(max_workers=PSF_THREADS) as pool:
+            results = pool.map(lambda sl: integrate(xi[sl], yi[sl], x_um[sl], y_um[sl], electron_dose[sl]), batches)
+            for lin, count in results:
+                all_lin.append(lin)
+                # cap what a single source can add to a pixel so that overlapping sources cannot overflow int32
+                all_counts.append(np.minimum(rng.poisson(count), _MAX_PSF_COUNT))
+
+        # one scatter for all sources. np.add.at sums overlapping windows correctly, and is fastest with 
+        # linear indices into the (contiguous) pixels and values of the same dtype.
+        np.add.at(pixels.reshape(-1), np.concatenate(all_lin), np.concatenate(all_counts).astype(pixels.dtype))
+
+    return psfKernel
+
+
+def _quadratureWeights(n, h):
+    '''
+    1D weights for integrating n evenly spaced samples with step h.
+    Uses Simpson's 1/3 rule when n is odd, otherwise the trapezoidal rule.
+    '''
+    w = np.full(n, h)
+    if n % 2 == 1:
+        w[1:-1:2] *= 4/3
+        w[2:-1:2] *= 2/3
+        w[[0,-1]] /= 3
+    else:
+        w[[0,-1]] /= 2
+    return w
@@ -1,3 +1,4 @@
+import os
 import functools
 import inspect
 import numpy as np
@@ -6,6 +7,9 @@ from collections.abc import Callable
 
 Number = Union[int, float]
 
+# Module-level flag to enable/disable type checking, also disabled by setting the environment variable STLIB_TYPECHECK=0
+ENABLE_TYPE_CHECK = os.environ.get("STLIB_TYPECHECK", "1") != "0"
+
 
 def type_checker(func):
     hints = get_type_hints(func)
@@ -62,6 +66,10 @@ def type_checker(func):
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+
+        if not ENABLE_TYPE_CHECK:
+            return func(*args, **kwargs)
+
         bound_args = sig.bind(*args, **kwargs)
         bound_args.apply_defaults()
 
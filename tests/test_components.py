@@ -60,6 +60,16 @@ def test_type_checker_astropy_unit():
     with pytest.raises(TypeError):
         typed_func("bad arg")
     
+def test_type_checker_disable():
+    @type_checker
+    def typed_func(arg: Number):
+        return arg
+    STLib.utils.typing.ENABLE_TYPE_CHECK = False
+    try:
+        assert typed_func("bad arg") == "bad arg"
+    finally:
+        STLib.utils.typing.ENABLE_TYPE_CHECK = True
+    
 def test_type_checker_nested_union():
     @type_checker
     def typed_func(arg: Union[Number, u.Quantity]):
@@ -151,6 +161,7 @@ def test_naif_schema_downpgrade():
 
 
 from STLib.functions.psf import airyPSFModel, defocusPSFModel, pillboxPSFModel, gaussianPSFModel
+from scipy.stats import multivariate_normal
 
 import numpy as np
 
@@ -176,6 +187,14 @@ def test_psf_gaussian():
     integral_error = abs(integral-1)
     assert integral_error < 1e-5, f"Expected 1 (± 1e-5), got error of {integral_error}"
 
+def test_psf_gaussian_cov():
+    cov = np.array([[9,2],[2,4]]) * u.micron**2
+    psf = gaussianPSFModel(cov=cov)
+
+    X, Y = np.meshgrid(np.linspace(-10,10,50), np.linspace(-8,9,40))
+    expected = multivariate_normal(mean=[0,0], cov=cov.value).pdf(np.dstack([X,Y]))
+    np.testing.assert_allclose(psf(X,Y), expected)
+
 def test_psf_airy():
     wavelength = 550*u.nm
     d = 1*u.cm
@@ -345,3 +364,76 @@ def test_filter_init_with_bad_file_ext(zp_flux):
 def test_filter_init_incomplete(zp_flux):
     with pytest.raises(ValueError, match="Please specify"):
         filter_ = Filter(zp_flux=zp_flux)
+
+
+
+
+
+@pytest.fixture
+def sensor_params():
+    return dict(width_px=8, height_px=6, px_len=5, px_pitch=5.5, quantum_efficiency=0.6,
+                dark_current=lambda T: 0.0, hot_pixels=None, read_noise=2, gain=0.5, bias=100,
+                full_well_capacity=1000, adc_limit=4095, bloom={'+x','-y'}, readout_time=0.01)
+
+def test_sensor_bloom(sensor_params):
+    sensor = Sensor(**sensor_params)
+    sensor.pixels[3,3] = 3000
+    sensor._applyBloom()
+    pixels = sensor.pixels
+    assert pixels.max() <= 1000
+    assert pixels[3,3] == 1000 and pixels[3,4] == 1000 and pixels[2,3] == 1000
+    assert pixels[3,2] == 0 and pixels[4,3] == 0
+    assert pixels.sum() == 3000
+
+def test_sensor_psf(sensor_params, psf):
+    sensor_params.update(px_len=5, px_pitch=5)  # no gaps between pixels, so all flux lands on the sensor
+    lens = Lens(aperture=1*u.cm, focal_length=1*u.cm, transmission_efficiency=1.0, psf=psf, 
+                auto_tune_integration_params=False, psf_bounds=15*u.micron, psf_resolution=0.5*u.micron)
+    sensor = Sensor(**sensor_params)
+    sensor.bindLens(lens)
+    sensor._applyPSF(np.array([20]), np.array([15]), np.array([1e6]))
+    assert sensor.pixels.sum() == pytest.approx(1e6, rel=1e-2)
+
+    # a source on the top left corner of the sensor only keeps a quarter of its flux
+    sensor.clear()
+    sensor._applyPSF(np.array([-5]), np.array([-5]), np.array([1e6]))
+    assert sensor.pixels.sum() == pytest.approx(2.5e5, rel=1e-2)
+
+def test_sensor_seed(sensor_params):
+    readouts = []
+    for _ in range(2):
+        sensor = Sensor(**sensor_params, seed=42)
+        sensor.pixels += 500
+        readouts.append(sensor.readout())
+    np.testing.assert_array_equal(readouts[0], readouts[1])
+
+def test_sensor_bloom_kernel(sensor_params):
+    sensor = Sensor(**sensor_params)
+    kernel = np.zeros((3,3))
+    kernel[1,2] = kernel[0,1] = 0.5  # same as {'+x','-y'}
+    sensor_params.update(bloom=kernel)
+    sensor_kernel = Sensor(**sensor_params)
+    for s in (sensor, sensor_kernel):
+        s.pixels[3,3] = 3000
+        s.pixels[0,7] = 2500
+        s._applyBloom()
+    np.testing.assert_array_equal(sensor.pixels, sensor_kernel.pixels)
+
+    kernel[1,1] = 0.5
+    with pytest.raises(ValueError):
+        sensor_params.update(bloom=kernel)
+        Sensor(**sensor_params)
+
+def test_sensor_bloom_large_kernel(sensor_params):
+    kernel = np.ones((9,9))
+    kernel[4,4] = 0
+    sensor_params.update(bloom=kernel / kernel.sum())
+    pixels = []
+    for overlap_add in (False, True):
+        sensor = Sensor(**sensor_params)
+        sensor._bloom_oa = overlap_add
+        sensor.pixels[3,3] = 40000
+        sensor._applyBloom()
+        pixels.append(sensor.pixels.copy())
+    assert pixels[1].max() <= 1000
+    np.testing.assert_allclose(pixels[0], pixels[1], atol=2)